@@ -5,22 +5,338 @@ Forensic tool for git repositories.
 Analyses a git repository and produces a JSON file summarising each file change.
 '''
 import argparse
-import datetime
+import concurrent.futures
 import git
-import json
+import itertools
+import msgspec
+import orjson
 import os
+import shutil
+import subprocess
 import sys
+import tempfile
 
 __authors__   = ["Kitserve <kitserve at users dot noreply dot github dot com>"]
 __copyright__ = "2024 Kitson Consulting Limited"
 __group__     = "git-log-json"
 __license__   = "GPLv3 or later"
 
+# Each commit header in the git log stream starts with COMMIT_MARKER, and its fields are separated by NULs.
+# The commit date is formatted by git as ISO 8601 in local time, without a UTC offset.
+COMMIT_MARKER = '__COMMIT__'
+LOG_FORMAT = f'{COMMIT_MARKER}%H%x00%an%x00%ae%x00%cd%x00%B%x00__END__'
+DATE_FORMAT = 'format-local:%Y-%m-%dT%H:%M:%S'
+
+# A single git process streams commits along with the status and line counts of each file they changed.
+# Merge commits are compared against their first parent, and root commits against the empty tree regardless of log.showRoot.
+# @see https://git-scm.com/docs/git-log#_raw_output_format
+LOG_ARGUMENTS = ('-z', '-M', '--raw', '--numstat', '--root', '--diff-merges=first-parent', '--no-show-signature', f'--format={LOG_FORMAT}', f'--date={DATE_FORMAT}')
+
+# Debug messages are written to stderr as bytes, bypassing print() and the text layer
+_log = sys.stderr.buffer.write
+
+# Environment for every git command run by this tool.
+# As the repo is only read, git can skip optional locks, such as the one taken to refresh the index when checking whether the repo is dirty.
+# @see https://git-scm.com/docs/git#Documentation/git.txt-codeGITOPTIONALLOCKScode
+GIT_ENVIRONMENT = {'GIT_OPTIONAL_LOCKS': '0'}
+
+# Output file buffer size in bytes, and the number of records joined into each write
+OUTPUT_BUFFER_SIZE = 4 * 1024 * 1024
+RECORDS_PER_WRITE = 1024
+
+# io_uring output: ring size, bytes per write, and the number of writes queued before they are submitted
+URING_ENTRIES = 256
+URING_BUFFER_SIZE = 64 * 1024
+URING_SUBMIT_BATCH = 32
+
+# Description of each change type reported by git
+# @see https://git-scm.com/docs/git-status
+STATUS_MAP = {
+	' ': 'Not modified',
+	'M': 'Modified',
+	'T': 'File type changed',
+	'A': 'Added',
+	'D': 'Deleted',
+	'R': 'Renamed',
+	'C': 'Copied',
+	'U': 'Updated but unmerged',
+}
+
+class FileRevision(msgspec.Struct):
+	'''
+	Output record for one file changed by one commit.
+	'''
+	revision: str
+	author: str
+	email: str
+	date: str
+	message: str
+	modified: str
+	extension: str
+	status: str
+	lines_added: int | None
+	lines_removed: int | None
+
+# msgspec compiles an encoder specialised for FileRevision the first time it is used
+RECORD_ENCODER = msgspec.json.Encoder()
+
+def read_fields(stream, chunk_size=65536):
+	'''
+	Reads a binary stream of NUL-terminated fields, as output by git with -z, and yields each field as a string.
+	'''
+	remainder = b''
+
+	while chunk := stream.read(chunk_size):
+		fields = (remainder + chunk).split(b'\0')
+		remainder = fields.pop()
+
+		for field in fields:
+			yield field.decode('utf-8', 'replace')
+
+	if remainder:
+		yield remainder.decode('utf-8', 'replace')
+
+def iter_diff_records(process):
+	'''
+	Parses the output of a git log process run with -z, --raw, --numstat and LOG_FORMAT.
+	Yields a (commit, records) tuple for each commit, where records is a list of (change type, path, lines added, lines removed) tuples.
+	Waits for the process once its output is exhausted, and raises subprocess.CalledProcessError if git failed.
+	'''
+	fields = read_fields(process.stdout)
+
+	commit = None
+	statuses = []
+	line_counts = []
+
+	# The trailing marker flushes the final commit
+	for field in itertools.chain(fields, [COMMIT_MARKER]):
+		# Raw and numstat records are terminated by NULs, but the header of each commit is preceded by the newline that ends the format string
+		field = field.lstrip('\n')
+
+		if field.startswith(COMMIT_MARKER):
+			if commit:
+				# The raw and numstat blocks list the same files in the same order
+				yield commit, [(change_type, file, lines_added, lines_removed) for (change_type, file), (lines_added, lines_removed) in zip(statuses, line_counts)]
+
+			revision = field[len(COMMIT_MARKER):]
+
+			if not revision:
+				break
+
+			# The remaining header fields are NUL-separated, so they are taken positionally
+			author, email, date, message, _ = (next(fields) for _ in range(5))
+			commit = {'revision': revision, 'author': author, 'email': email, 'date': date, 'message': message.strip()}
+			statuses = []
+			line_counts = []
+
+		# Raw record, e.g. ":100644 100644 bcd1234 0123456 M", followed by the path, or by the source and destination paths for renames and copies
+		elif field.startswith(':'):
+			change_type = field.rsplit(' ', 1)[-1][0]
+			file = next(fields)
+
+			if change_type in ('R', 'C'):
+				file = next(fields)
+
+			statuses.append((change_type, file))
+
+		# Numstat record, e.g. "3\t1\tpath", where the path is empty for renames and copies and given by the next two fields instead.
+		# Binary files show "-" in place of the line counts, which are recorded as None.
+		elif field:
+			added, removed, file = field.split('\t', 2)
+
+			if not file:
+				next(fields)
+				next(fields)
+
+			line_counts.append((None if added == '-' else int(added), None if removed == '-' else int(removed)))
+
+	if process.wait():
+		raise subprocess.CalledProcessError(process.returncode, process.args)
+
+def start_git_log(path, *arguments, stdin=None):
+	'''
+	Starts a git log process with LOG_ARGUMENTS and the given arguments on the repo at path, reading its binary output from a pipe.
+	GitPython's command wrapper is bypassed, as the output is streamed and parsed here anyway.
+	'''
+	return subprocess.Popen(['git', '-C', path, 'log', *LOG_ARGUMENTS, *arguments], stdin=stdin, stdout=subprocess.PIPE, env=os.environ | GIT_ENVIRONMENT)
+
+def encode_records(records, separator, indent=False):
+	'''
+	Encodes a batch of FileRevision records as JSON, joined by the separator.
+	Indented records are encoded one at a time with orjson, as msgspec can't indent its output.
+	Otherwise the whole batch is encoded in a single msgspec call, as JSON Lines for a newline separator or as an array for a comma separator, trimming the trailing newline or the brackets.
+	'''
+	if indent:
+		return separator.join(orjson.dumps(msgspec.structs.asdict(record), option=orjson.OPT_INDENT_2) for record in records)
+	elif separator == b'\n':
+		return RECORD_ENCODER.encode_lines(records)[:-1]
+	else:
+		return RECORD_ENCODER.encode(records)[1:-1]
+
+def write_revisions(output_file, process, separator, indent=False):
+	'''
+	Writes a JSON record for each file revision in the output of a git log process, joining the records with the separator.
+	Returns the number of records and commits written.
+	'''
+	total_commits = 0
+	total_revisions = 0
+
+	first_entry = True
+
+	# Records are encoded and written in batches to keep the number of writes down
+	pending_records = []
+
+	# The same paths recur across many commits, so their extensions are only worked out once
+	extensions = {}
+
+	for commit, records in iter_diff_records(process):
+		commit_fields = tuple(commit.values())
+
+		for change_type, file, lines_added, lines_removed in records:
+			status = STATUS_MAP.get(change_type, 'Unknown')
+
+			extension = extensions.get(file)
+
+			if extension is None:
+				extension = extensions[file] = os.path.splitext(file)[1]
+
+			pending_records.append(FileRevision(*commit_fields, file, extension, status, lines_added, lines_removed))
+
+			total_revisions += 1
+
+			if len(pending_records) == RECORDS_PER_WRITE:
+				if not first_entry:
+					output_file.write(separator)
+				output_file.write(encode_records(pending_records, separator, indent))
+				pending_records = []
+				first_entry = False
+
+		total_commits += 1
+
+	if pending_records:
+		if not first_entry:
+			output_file.write(separator)
+		output_file.write(encode_records(pending_records, separator, indent))
+
+	return total_revisions, total_commits
+
+def analyse_commits(path, revisions, separator, temporary_directory, indent=False):
+	'''
+	Analyses the given commits, in order, in a worker process.
+	Writes the JSON records, joined by the separator, to a temporary file in temporary_directory rather than collecting them in memory.
+	Returns the name of the temporary file, which the caller must delete, along with the number of records and commits.
+	'''
+	process = start_git_log(path, '--no-walk=unsorted', '--stdin', stdin=subprocess.PIPE)
+	process.stdin.write(''.join(f'{revision}\n' for revision in revisions).encode())
+	process.stdin.close()
+
+	with tempfile.NamedTemporaryFile('wb', buffering=OUTPUT_BUFFER_SIZE, prefix='git-log-json-', dir=temporary_directory, delete=False) as output_file:
+		try:
+			total_revisions, total_commits = write_revisions(output_file, process, separator, indent)
+		except:
+			os.remove(output_file.name)
+			raise
+
+	return output_file.name, total_revisions, total_commits
+
+class UringWriter:
+	'''
+	Binary file writer that hands its output to the kernel through io_uring, as an alternative to buffered write() calls.
+	Output is gathered into buffers of URING_BUFFER_SIZE bytes, each of which is written at its offset in the file by one submission queue entry.
+	Entries are submitted in batches, and completions are only reaped when the ring is full or the file is closed.
+	Requires the optional liburing package.
+	@see https://github.com/YoSTEALTH/Liburing
+	'''
+	def __init__(self, file_name):
+		# Imported here so that liburing is only needed when io_uring output is requested
+		import liburing
+
+		self.liburing = liburing
+		self.ring = liburing.Ring()
+		self.cqe = liburing.Cqe()
+		# Set up the ring before touching the output file, as this fails wherever io_uring is blocked, e.g. by seccomp or kernel.io_uring_disabled
+		liburing.io_uring_queue_init(URING_ENTRIES, self.ring)
+
+		try:
+			self.fd = os.open(file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+		except OSError:
+			liburing.io_uring_queue_exit(self.ring)
+			raise
+
+		self.buffer = bytearray()
+		self.offset = 0
+		self.unsubmitted = 0
+		# Buffers must stay alive until the kernel has finished with them, so they are kept here keyed by file offset
+		self.in_flight = {}
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def write(self, data):
+		self.buffer += data
+
+		if len(self.buffer) >= URING_BUFFER_SIZE:
+			self.queue_buffer()
+
+	def queue_buffer(self):
+		if len(self.in_flight) == URING_ENTRIES:
+			self.reap()
+
+		buffer = bytes(self.buffer)
+		self.buffer.clear()
+
+		sqe = self.liburing.io_uring_get_sqe(self.ring)
+		self.liburing.io_uring_prep_write(sqe, self.fd, buffer, self.offset)
+		self.liburing.io_uring_sqe_set_data64(sqe, self.offset)
+		self.in_flight[self.offset] = buffer
+		self.offset += len(buffer)
+		self.unsubmitted += 1
+
+		if self.unsubmitted == URING_SUBMIT_BATCH:
+			self.submit()
+
+	def submit(self):
+		self.liburing.io_uring_submit(self.ring)
+		self.unsubmitted = 0
+
+	def reap(self):
+		# Waiting on entries that haven't been submitted would block forever
+		if self.unsubmitted:
+			self.submit()
+
+		self.liburing.io_uring_wait_cqe(self.ring, self.cqe)
+		cqe = self.cqe[0]
+		offset = self.liburing.io_uring_cqe_get_data64(cqe)
+		written = self.liburing.trap_error(cqe.res)
+		self.liburing.io_uring_cqe_seen(self.ring, cqe)
+
+		# Finish off short writes synchronously
+		buffer = self.in_flight.pop(offset)
+
+		while written < len(buffer):
+			written += os.pwrite(self.fd, buffer[written:], offset + written)
+
+	def close(self):
+		if self.buffer:
+			self.queue_buffer()
+
+		while self.in_flight:
+			self.reap()
+
+		self.liburing.io_uring_queue_exit(self.ring)
+		os.close(self.fd)
+
 def main(argv):
 	argumentParser = argparse.ArgumentParser(description='Git commit analyser')
 	argumentParser.add_argument('-p', '--path', help='Path to Git directory', required=True)
 	argumentParser.add_argument('-b', '--branch', help='Branch to analyse, defaults to the current active branch', required=False)
 	argumentParser.add_argument('-o', '--output-file', help='Name of analysis results file', required=True)
+	argumentParser.add_argument('-f', '--format', help='Output format, either a JSON array or newline-delimited JSON with one record per line, defaults to json', choices=['json', 'jsonl'], default='json')
+	argumentParser.add_argument('-j', '--jobs', help='Number of worker processes, defaults to the number of CPUs. With more than one, each worker writes its share of the output to a temporary file alongside the output file, so up to the size of the output file is needed in extra space there', type=int, default=os.cpu_count() or 1)
+	argumentParser.add_argument('--use-uring', help='Write the output file through io_uring, which requires the liburing package', default=False, action='store_true')
 	argumentParser.add_argument('-d', '--debug', help='Output extra debugging information', default=False, action='store_true')
 	args = vars(argumentParser.parse_args())
 
@@ -37,13 +353,15 @@ def main(argv):
 		print(f'{path} is not a valid git repository. Terminating.', file=sys.stderr)
 		sys.exit(2)
 
+	repo.git.update_environment(**GIT_ENVIRONMENT)
+
 	if args['debug']:
-		print(f'Debug: repo "{path}" is {"not " if not repo.bare else ""}bare.', file=sys.stderr)
+		_log(f'Debug: repo "{path}" is {"not " if not repo.bare else ""}bare.\n'.encode())
 		# @see https://github.com/gitpython-developers/GitPython/issues/633
 		try:
-			print(f'Debug: repo "{path}" is currently on branch "{repo.active_branch}".', file=sys.stderr)
+			_log(f'Debug: repo "{path}" is currently on branch "{repo.active_branch}".\n'.encode())
 		except:
-			print(f'Debug: repo "{path}" is currently in detached head state.', file=sys.stderr)
+			_log(f'Debug: repo "{path}" is currently in detached head state.\n'.encode())
 
 	# Warn if there are changes that haven't yet made it into Git history
 	if repo.is_dirty():
@@ -63,104 +381,116 @@ def main(argv):
 		# Check that the requested branch exists in the repo
 		else:
 			branch = None
-			for ref in repo.references:
-				if args['branch'] == 'main':
-					if 'main' == ref.name:
-						branch = 'main'
-						break
-					elif 'master' == ref.name:
-						branch = 'master'
-						break
-				else:
-					if args['branch'] == ref.name:
-						branch = args['branch']
-						break
+			ref_names = {ref.name for ref in repo.references}
+
+			# Fall back to master for repos that predate main being the default branch name
+			if args['branch'] == 'main':
+				if 'main' in ref_names:
+					branch = 'main'
+				elif 'master' in ref_names:
+					branch = 'master'
+			elif args['branch'] in ref_names:
+				branch = args['branch']
 
 	except Exception as e:
 		print(f'Error: repo "{path}" is in detached head state. Error details:\n{e}\nExiting.', file=sys.stderr)
 		sys.exit(4)
 
-		if not branch:
-			print(f'Branch "{args["branch"]}" not found in repo "{path}". Terminating.', file=sys.stderr)
-			sys.exit(3)
+	if not branch:
+		print(f'Branch "{args["branch"]}" not found in repo "{path}". Terminating.', file=sys.stderr)
+		sys.exit(3)
 
 	total_commits = 0
 	total_revisions = 0
 
-	first_entry = True
+	# JSON Lines records can't span lines, so they are never indented
+	# @see https://jsonlines.org/
+	if args['format'] == 'jsonl':
+		separator = b'\n'
+		indent = False
+	else:
+		separator = b',\n' if args['debug'] else b','
+		indent = args['debug']
 
-	# @note We should probably be using git.diff.Diffable.NULL_TREE instead of this.
-	# @see https://github.com/gitpython-developers/GitPython/issues/364
-	# @see https://stackoverflow.com/questions/33916648/get-the-diff-details-of-first-commit-in-gitpython
-	EMPTY_TREE_SHA = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
-
-	with open(args['output_file'], 'w') as output_file:
-		output_file.write('[')
-
-		if args['debug']:
-			output_file.write('\n')
-
-		# iter_commits() returns an iterator rather than a list, so we need to output each revision record as a separate JSON string
-		for commit in repo.iter_commits(rev=branch):
-			previous_commit = commit.parents[0] if commit.parents else EMPTY_TREE_SHA
-
-			diffs = {
-				diff.a_path: diff for diff in commit.diff(previous_commit, R=True)
-			}
-
-			for file, stats in commit.stats.files.items():
-				diff = diffs.get(file)
-
-				if not diff:
-					for diff in diffs.values():
-						if diff.b_path == path and diff.renamed:
-							break
-
-				# @see https://git-scm.com/docs/git-status
-				if diff.change_type == ' ':
-					status = 'Not modified'
-				elif diff.change_type == 'M':
-					status = 'Modified'
-				elif diff.change_type == 'T':
-					status = 'File type changed'
-				elif diff.change_type == 'A':
-					status = 'Added'
-				elif diff.change_type == 'D':
-					status = 'Deleted'
-				elif diff.change_type == 'R':
-					status = 'Renamed'
-				elif diff.change_type == 'C':
-					status = 'Copied'
-				elif diff.change_type == 'U':
-					status = 'Updated but unmerged'
-				else:
-					status = 'Unknown'
+	output_file = None
 
-				if not first_entry:
-					output_file.write(',')
+	if args['use_uring']:
+		try:
+			output_file = UringWriter(args['output_file'])
+		except ImportError:
+			print('The liburing package is required for --use-uring. Terminating.', file=sys.stderr)
+			sys.exit(5)
+		# Fall back to the plain buffered file
+		except OSError as e:
+			print(f'Warning: io_uring is unavailable, so "{args["output_file"]}" will be written without it. Error details:\n{e}', file=sys.stderr)
 
-				if args['debug']:
-					if not first_entry:
-						output_file.write('\n')
-					output_file.write(json.dumps({'revision': commit.hexsha, 'author': commit.author.name, 'email': commit.author.email, 'date': datetime.datetime.fromtimestamp(commit.committed_date).isoformat(), 'message': commit.message.strip(), 'modified': file, 'extension': f'.{os.path.basename(file).split('.')[-1]}', 'status': status, 'lines_added': stats['insertions'], 'lines_removed': stats['deletions']}, indent=1))
-				else:
-					output_file.write(json.dumps({'revision': commit.hexsha, 'author': commit.author.name, 'email': commit.author.email, 'date': datetime.datetime.fromtimestamp(commit.committed_date).isoformat(), 'message': commit.message.strip(), 'modified': file, 'extension': f'.{os.path.basename(file).split('.')[-1]}', 'status': status, 'lines_added': stats['insertions'], 'lines_removed': stats['deletions']}))
+	if output_file is None:
+		output_file = open(args['output_file'], 'wb', buffering=OUTPUT_BUFFER_SIZE)
 
-				total_revisions += 1
-				first_entry = False
+	with output_file:
+		if args['format'] == 'json':
+			output_file.write(b'[')
+
+			if args['debug']:
+				output_file.write(b'\n')
+
+		try:
+			if args['jobs'] > 1:
+				# Split the history into one contiguous range of commits per worker, and join the workers' output in order
+				revisions = subprocess.run(['git', '-C', path, 'rev-list', '--reverse', str(branch), '--'], stdout=subprocess.PIPE, check=True, env=os.environ | GIT_ENVIRONMENT).stdout.decode().split()
+				shard_size = max(1, -(-len(revisions) // args['jobs']))
+				shards = [revisions[i:i + shard_size] for i in range(0, len(revisions), shard_size)]
+
+				with concurrent.futures.ProcessPoolExecutor(max_workers=len(shards) or 1) as executor:
+					# Keep the shards on the filesystem the user chose for the output, rather than the system temp directory, which may be in memory
+					temporary_directory = os.path.dirname(os.path.abspath(args['output_file']))
+					futures = [executor.submit(analyse_commits, path, shard, separator, temporary_directory, indent) for shard in shards]
+
+					try:
+						for future in futures:
+							shard_file_name, shard_revisions, shard_commits = future.result()
+
+							if shard_revisions:
+								if total_revisions:
+									output_file.write(separator)
+
+								with open(shard_file_name, 'rb') as shard_file:
+									shutil.copyfileobj(shard_file, output_file, OUTPUT_BUFFER_SIZE)
+
+							total_revisions += shard_revisions
+							total_commits += shard_commits
+					# Remove every shard's temporary file, including those not yet copied if a worker failed
+					finally:
+						for future in futures:
+							if not future.cancelled() and future.exception() is None:
+								shard_file_name = future.result()[0]
+
+								if os.path.exists(shard_file_name):
+									os.remove(shard_file_name)
+			else:
+				# The trailing -- stops git mistaking a branch for a path of the same name
+				process = start_git_log(path, '--reverse', str(branch), '--')
+				total_revisions, total_commits = write_revisions(output_file, process, separator, indent)
 
-			total_commits += 1
+		# git has already printed the reason for the failure to stderr
+		except subprocess.CalledProcessError as e:
+			print(f'Error: git failed while analysing repo "{path}". Error details:\n{e}\nTerminating.', file=sys.stderr)
+			sys.exit(6)
 
-		if args['debug']:
-			output_file.write('\n')
+		if args['format'] == 'json':
+			if args['debug']:
+				output_file.write(b'\n')
 
-		output_file.write(']')
+			output_file.write(b']')
 
-		if args['debug']:
-			output_file.write('\n')
+			if args['debug']:
+				output_file.write(b'\n')
+		# Terminate the last line
+		elif total_revisions:
+			output_file.write(b'\n')
 
 	if args['debug']:
-		print(f'Debug: wrote {total_revisions} file modification record(s) from {total_commits} commit(s) in repo "{path}" on branch "{branch}" to JSON file "{args["output_file"]}".')
+		_log(f'Debug: wrote {total_revisions} file modification record(s) from {total_commits} commit(s) in repo "{path}" on branch "{branch}" to JSON file "{args["output_file"]}".\n'.encode())
 
 if __name__ == '__main__':
 	main(sys.argv)